@@ -1,31 +1,56 @@
 import logging
-import re
+import posixpath
 import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from queue import Queue, Empty as QueueIsEmpty
+from functools import lru_cache
+from queue import Queue
 from typing import List, Optional
-from urllib.parse import urlparse, urljoin, urlsplit, urlunsplit, quote
-from urllib.request import Request, urlopen
+from urllib.parse import SplitResult, urljoin, urlsplit, urlunsplit, quote
 
+import requests
 import robots
+from requests.adapters import HTTPAdapter, Retry
+from selectolax.lexbor import LexborHTMLParser
+
+# Crawled sites repeat the same links on every page, so memoize parsing
+_cached_urlsplit = lru_cache(maxsize=8192)(urlsplit)
+
+
+class UrlJob:
+    """
+    Url in crawl queue with its already parsed parts
+    """
+    __slots__ = ('url', 'split')
+
+    def __init__(self, url: str, split: SplitResult):
+        self.url = url
+        self.split = split
 
 
 class Sitemap:
     _xml_header = '<?xml version="1.0" encoding="UTF-8"?>'
     _xml_sitemap_schema = 'xmlns="https://www.sitemaps.org/schemas/sitemap/0.9"'
     _MAX_URL_PER_FILE = 50000  # https://www.sitemaps.org/protocol.html
+    _date_format = '%Y-%m-%dT%H:%M:%S+00:00'
+    _MAX_WRITE_WORKERS = 8
 
     def __init__(self):
-        self._urls = []
+        self._urls: List[str] = []  # finished <url> entries
+        self._url_set = set()
+        self._lock = threading.Lock()
 
     def add_url(self, url: str, date: datetime):
-        self._urls.append(
-            {
-                'loc': url,
-                'lastmod': date
-            }
-        )
+        # store finished <url> entry, so writing is pure concatenation
+        entry = (f"<url><loc> {self._convert_html_special_chars(url)} </loc>"
+                 f"<lastmod> {date.strftime(self._date_format)} </lastmod></url>")
+        with self._lock:
+            self._url_set.add(url)
+            self._urls.append(entry)
+
+    def contains(self, url: str) -> bool:
+        with self._lock:
+            return url in self._url_set
 
     def create_sitemap(self):
         multi_file = len(self._urls) > self._MAX_URL_PER_FILE
@@ -35,100 +60,108 @@ class Sitemap:
             if len(self._urls) % self._MAX_URL_PER_FILE != 0:
                 files_num += 1
 
-            sitemap_files = []
-            for i in range(files_num):
-                filename = f'sitemap{i + 1}.xml'
-                sitemap_files.append(filename)
-                self._create_sitemap_file(filename,
+            sitemap_files = [f'sitemap{i + 1}.xml' for i in range(files_num)]
+
+            def create_file(i):
+                self._create_sitemap_file(sitemap_files[i],
                                           self._urls[i * self._MAX_URL_PER_FILE: (i + 1) * self._MAX_URL_PER_FILE])
 
+            # files are independent, so write them concurrently
+            with ThreadPoolExecutor(max_workers=self._MAX_WRITE_WORKERS) as executor:
+                list(executor.map(create_file, range(files_num)))
+
             self._create_index_sitemap_file(sitemap_files)
 
         else:
             self._create_sitemap_file('expamles/sitemap_pythonorg.xml', self._urls)
 
     def _create_index_sitemap_file(self, sitemap_file_names):
-        with open('sitemap_index.xml', 'w') as f:
-            f.write(self._xml_header)
-            f.write(f"<sitemapindex {self._xml_sitemap_schema}>")
-
-            for sitemap in sitemap_file_names:
-                f.write("<sitemap>")
-                f.write(f"<loc> /{sitemap} </loc>")
-                f.write("</sitemap>")
+        parts = [self._xml_header, f"<sitemapindex {self._xml_sitemap_schema}>"]
+        for sitemap in sitemap_file_names:
+            parts.append(f"<sitemap><loc> /{sitemap} </loc></sitemap>")
+        parts.append("</sitemapindex>")
 
-            f.write("</sitemapindex>")
+        with open('sitemap_index.xml', 'w') as f:
+            f.write(''.join(parts))
 
     def _create_sitemap_file(self, filename: str, urls):
         with open(filename, 'w') as f:
-            f.write(self._xml_header)
-            f.write(f"<urlset {self._xml_sitemap_schema}>")
-
-            for url in urls:
-                f.write("<url>")
-                f.write(f"<loc> {url['loc']} </loc>")
-                f.write(f"<lastmod> {url['lastmod'].strftime('%Y-%m-%dT%H:%M:%S+00:00')} </lastmod>")
-                f.write("</url>")
+            f.write(f"{self._xml_header}<urlset {self._xml_sitemap_schema}>{''.join(urls)}</urlset>")
 
-            f.write("</urlset>")
+    @staticmethod
+    def _convert_html_special_chars(link):
+        # chained replace is faster than str.translate or html.escape here,
+        # replace without a match returns the same string without copying
+        return link \
+            .replace("&", "&amp;") \
+            .replace('"', "&quot;") \
+            .replace("<", "&lt;") \
+            .replace(">", "&gt;")
 
-    @property
-    def url(self):
-        return self._urls
+    def __len__(self):
+        return len(self._urls)
 
 
 class Crawler(threading.Thread):
-    link_regex = re.compile(b'<a [^>]*href=[\'|"](.*?)[\'"][^>]*?>')
-    invalid_formats = (
-        ".epub", ".mobi", ".docx", ".doc", ".opf",
-        ".7z", ".ibooks", ".cbr", ".avi", ".mkv",
-        ".mp4", ".jpg", ".jpeg", ".png", ".gif",
-        ".pdf", ".iso", ".rar", ".tar", ".tgz",
-        ".zip", ".dmg", ".exe")
+    invalid_formats = frozenset((
+        "epub", "mobi", "docx", "doc", "opf",
+        "7z", "ibooks", "cbr", "avi", "mkv",
+        "mp4", "jpg", "jpeg", "png", "gif",
+        "pdf", "iso", "rar", "tar", "tgz",
+        "zip", "dmg", "exe"))
     User_Agent = "PythonCrawler"
+    _MAX_HTML_BYTES = 2 * 1024 * 1024  # links of bigger pages are searched only in this part
     _logger = logging.getLogger('CrawlingWorker')
 
     def __init__(self,
                  base_url: str,
                  crawl_queue: Queue,
                  crawled: set,
+                 enqueued: set,
+                 enqueued_lock: threading.Lock,
                  excluded: set,
                  sitemap: Sitemap,
+                 robots_parser: robots.RobotsParser,
+                 session: requests.Session,
                  ):
 
         threading.Thread.__init__(self)
 
         self.base_url_str = base_url
-        self.base_url_obj = urlparse(base_url)
+        self.base_url_obj = _cached_urlsplit(base_url)
         self.crawl_queue = crawl_queue
         self.crawled = crawled
+        self.enqueued = enqueued
+        self.enqueued_lock = enqueued_lock
 
         self.sitemap = sitemap
         self.excluded = excluded
 
-        self.robots_parser = None
+        self.robots_parser = robots_parser
+        self.session = session
 
-    def _get_url(self):
+    def _get_url(self) -> Optional[UrlJob]:
         """
         Getting url from crawl queue.
-        Return none if queue is empty.
+        Return none when crawling is finished.
         """
-        try:
-            current_url = self.crawl_queue.get(block=True, timeout=5)
-        except QueueIsEmpty:
-            current_url = None
-
-        return current_url
+        return self.crawl_queue.get()
 
     @staticmethod
-    def _prepare_url(url_str):
+    def _prepare_url(url_split: SplitResult) -> SplitResult:
+        """
+        Quoting url path if contains non-ascii symbols
+        """
+        return url_split._replace(path=quote(url_split.path))
+
+    @classmethod
+    def _is_invalid_format(cls, path) -> bool:
         """
-        Quoting url if contains non-ascii symbols
+        Check url path extension against formats
+        which should not be downloaded
         """
-        url_split = list(urlsplit(url_str))
-        url_split[2] = quote(url_split[2])
-        url = urlunsplit(url_split)
-        return url
+        dot = path.rfind('.')
+        return dot >= 0 and path[dot + 1:].lower() in cls.invalid_formats
 
     @staticmethod
     def _get_date_from_response(response) -> datetime:
@@ -136,46 +169,35 @@ class Crawler(threading.Thread):
         Try to get last-modified info
         Or set current date
         """
-        if 'last-modified' in response.headers:
-            date = response.headers['Last-Modified']
-        else:
-            date = response.headers['Date']
+        # requests joins repeated headers with ", ", so take
+        # the first value from the raw headers, as urllib did
+        headers = response.raw.headers
+        dates = headers.getlist('Last-Modified') or headers.getlist('Date')
 
-        return datetime.strptime(date, '%a, %d %b %Y %H:%M:%S %Z')
+        return datetime.strptime(dates[0], '%a, %d %b %Y %H:%M:%S %Z')
 
     @staticmethod
     def _resolve_url_path(path):
-        # From https://stackoverflow.com/questions/4317242/python-how-to-resolve-urls-containing/40536115#40536115
-        segments = path.split('/')
-        segments = [segment + '/' for segment in segments[:-1]] + [segments[-1]]
-        resolved = []
-        for segment in segments:
-            if segment in ('../', '..'):
-                if resolved[1:]:
-                    resolved.pop()
-            elif segment not in ('./', '.'):
-                resolved.append(segment)
-        return ''.join(resolved)
+        if not path:
+            return path
+
+        resolved = posixpath.normpath(path)
+        # normpath drops trailing slash, but for urls it matters
+        if path.endswith(('/', '/.', '/..')) and not resolved.endswith('/'):
+            resolved += '/'
+        return resolved
 
     def _clean_link(self, link):
-        parts = list(urlsplit(link))
+        parts = list(_cached_urlsplit(link))
         parts[2] = self._resolve_url_path(parts[2])
         return urlunsplit(parts)
 
-    @staticmethod
-    def _convert_html_special_chars(link):
-        return link \
-            .replace("&", "&amp;") \
-            .replace('"', "&quot;") \
-            .replace("<", "&lt;") \
-            .replace(">", "&gt;")
-
-    def _check_robots(self):
-        robots_url = urljoin(self.base_url_str, 'robots.txt')
-        self.robots_parser = robots.RobotsParser.from_uri(robots_url)
-
     def _can_fetch(self, link):
-        return self.robots_parser.can_fetch("*", link)
+        try:
+            return self.robots_parser.can_fetch("*", link)
+        except ValueError as e:
+            logging.debug(f"Unable to check robots rules for {link}: {e}")
+            return False
 
     def _exclude_url(self, link):
         for ex in self.excluded:
@@ -183,109 +205,162 @@ class Crawler(threading.Thread):
                 return False
         return True
 
-    def run(self):
-        # load and parse robots if exists
-        logging.debug("Started work")
-        self._check_robots()
-
-        while True:
-            # try get from queue
-            current_url_str = self._get_url()
-            if not current_url_str:
-                break
-
-            # add to crawled or crawling
-            self.crawled.add(current_url_str)
-
-            # quoting url when have non ascii
-            current_url_str = self._prepare_url(current_url_str)
-            current_url_obj = urlparse(current_url_str)
-
-            # prepare request
-            request = Request(current_url_str, headers={"User-Agent": self.User_Agent})
+    def _crawl_url(self, job: UrlJob):
+        """
+        Download page, add it to sitemap
+        and put found links to crawl queue
+        """
+        # add to crawled or crawling
+        self.crawled.add(job.url)
+
+        # quoting url when have non ascii
+        current_url_obj = self._prepare_url(job.split)
+        current_url_str = urlunsplit(current_url_obj)
+
+        # check is invalid format and get resp
+        if not self._is_invalid_format(current_url_obj.path):
+            try:
+                response = self.session.get(current_url_str, timeout=10, stream=True)
+            except Exception as e:
+                logging.debug(f"Unable to open {current_url_str}. {e}")
+                return
+        else:
+            response = None
 
-            # check is invalid format and get resp
-            if not current_url_obj.path.endswith(self.invalid_formats):
-                try:
-                    response = urlopen(request, timeout=10)
-                except Exception as e:
-                    logging.debug(f"Unable to open {current_url_str}. {e}")
-                    continue
-            else:
-                response = None
+        # handling response
+        response_data, date = None, None
+        if response is not None:
+            try:
+                response.raise_for_status()
+                response_data = response.raw.read(self._MAX_HTML_BYTES, decode_content=True)
 
-            # handling response
-            response_data, date = None, None
-            if response is not None:
-                try:
-                    response_data = response.read()
-                    response.close()
+                date = self._get_date_from_response(response)
 
-                    date = self._get_date_from_response(response)
+            except Exception as e:
+                logging.debug(f"An error except when handling response: {e}")
+                return
+            finally:
+                response.close()
 
-                except Exception as e:
-                    logging.debug(f"An error except when handling response: {e}")
-                    continue
+            response_url_string = response.url
 
-                response_url_string = response.geturl()
+        else:
+            response_url_string = current_url_str
+            date = datetime.now()
 
-            else:
-                response_url_string = current_url_str
-                date = datetime.now()
+        # Add url to sitemap
+        self.sitemap.add_url(response_url_string, date)
 
-            # Add url to sitemap
-            self.sitemap.add_url(self._convert_html_special_chars(response_url_string), date)
+        # if page not loading
+        if not response_data:
+            return
 
-            # if page not loading
-            if not response_data:
+        # Find links
+        if response_url_string == current_url_str:
+            # not redirected, the common case
+            response_url_obj = current_url_obj
+        else:
+            response_url_obj = _cached_urlsplit(response_url_string)
+        # constant for all links of the page
+        scheme, path = response_url_obj.scheme, response_url_obj.path
+        base = scheme + '://' + response_url_obj.netloc
+        page = base + path
+        page_url = response_url_string.partition('#')[0]
+        directory = base + (path[:path.rfind('/') + 1] or '/')
+        base_netloc = self.base_url_obj.netloc
+        enqueued, crawled = self.enqueued, self.crawled
+        crawl_queue_put = self.crawl_queue.put
+
+        for node in LexborHTMLParser(response_data).css('a[href]'):
+            link_str = (node.attributes.get('href') or '').strip()
+            if not link_str:
                 continue
 
-            # Find links
-            response_url_obj = urlparse(response_url_string)
-            links: List[bytes, ...] = self.link_regex.findall(response_data)
-            for link_str in links:
-                link_str = link_str.decode("utf-8", errors="ignore")
-
-                if link_str.startswith('/'):
-                    link_str = response_url_obj.scheme + '://' + response_url_obj[1] + link_str
+            # resolve simple forms by hand, urljoin only as a fallback
+            try:
+                if link_str.startswith(('http://', 'https://')):
+                    pass
+                elif link_str.startswith('//'):
+                    link_str = scheme + ':' + link_str
+                elif link_str.startswith('/'):
+                    link_str = base + link_str
                 elif link_str.startswith('#'):
-                    link_str = response_url_obj.scheme + '://' + response_url_obj[1] + response_url_obj[2] + link_str
-                elif not link_str.startswith(('http', "https")):
-                    link_str = self._clean_link(urljoin(response_url_string, link_str))
-                elif link_str.startswith(("mailto", "tel")):
+                    link_str = page_url + link_str
+                elif link_str.startswith('?'):
+                    link_str = page + link_str
+                elif link_str.startswith(('mailto:', 'tel:')):
                     continue
+                elif _cached_urlsplit(link_str).scheme:
+                    # other schemes, like javascript: or ftp:
+                    link_str = urljoin(response_url_string, link_str)
+                else:
+                    # relative path, dot segments are resolved by cleaning
+                    link_str = self._clean_link(directory + link_str)
 
                 # Remove the anchor part if needed
                 if "#" in link_str:
                     link_str = link_str[:link_str.index('#')]
 
                 # Parse the url to get domain and file extension
-                link_obj = urlparse(link_str)
-                domain_link = link_obj.netloc
+                link_obj = _cached_urlsplit(link_str)
+            except ValueError as e:
+                # skip only this link, like href="http://[bad"
+                logging.debug(f"Invalid link {link_str}: {e}")
+                continue
 
-                if link_str in self.sitemap.url:
-                    continue
-                if link_str in self.crawl_queue.queue:
-                    continue
-                if domain_link != self.base_url_obj.netloc:
-                    continue
-                if link_obj.path in ["", "/"] and link_obj.query == '':
-                    continue
-                if "javascript" in link_str:
-                    continue
-                if link_obj.path.startswith("data:"):
-                    continue
+            domain_link = link_obj.netloc
 
-                if not self._can_fetch(link_str):
-                    continue
-                if link_str in self.crawled:
-                    continue
-                if not self._exclude_url(link_str):
+            if self.sitemap.contains(link_str):
+                continue
+            if link_str in enqueued:
+                continue
+            if domain_link != base_netloc:
+                continue
+            if link_obj.path in ("", "/") and link_obj.query == '':
+                continue
+            if "javascript" in link_str:
+                continue
+            if link_obj.path.startswith("data:"):
+                continue
+
+            if not self._can_fetch(link_str):
+                continue
+            if link_str in crawled:
+                continue
+            if not self._exclude_url(link_str):
+                continue
+
+            # check again under lock, another worker may have queued it meanwhile
+            with self.enqueued_lock:
+                if link_str in enqueued:
                     continue
+                enqueued.add(link_str)
+
+            # files are not downloaded, so add them to sitemap without queueing
+            if self._is_invalid_format(link_obj.path):
+                self.sitemap.add_url(urlunsplit(self._prepare_url(link_obj)), datetime.now())
+                continue
 
-                self.crawl_queue.put(link_str)
+            crawl_queue_put(UrlJob(link_str, link_obj))
+
+    def run(self):
+        logging.debug("Started work")
+
+        while True:
+            # blocks until next url or stop signal
+            job = self._get_url()
+            if job is None:
+                # pass stop signal to the next worker
+                self.crawl_queue.put(None)
+                break
 
-            self.crawl_queue.task_done()
+            try:
+                self._crawl_url(job)
+            except Exception as e:
+                # one bad page must not stop the worker
+                logging.debug(f"An error except when crawling {job.url}: {e}")
+            finally:
+                self.crawl_queue.task_done()
 
         logging.debug("Stopped working")
 
@@ -295,9 +370,14 @@ class CrawlingManager:
     _crawling_queue: Queue
     _excluded_urls: set
     _crawled_urls: set
+    _enqueued_urls: set
+    _enqueued_lock: threading.Lock
     _sitemap: Sitemap
+    _robots_parser: robots.RobotsParser
+    _session: requests.Session
     _crawler_workers: List[Crawler]
     _num_workers: int
+    _crawling_finished: threading.Event
 
     def __init__(self, base_url, *,
                  excluded_urls: Optional[set] = None,
@@ -306,34 +386,75 @@ class CrawlingManager:
         self._crawling_queue = Queue()
         self._sitemap = Sitemap()
         self._crawled_urls = set([])
+        self._enqueued_urls = set([self._base_url])
+        self._enqueued_lock = threading.Lock()
         self._crawler_workers = []
         self._num_workers = num_workers
+        self._crawling_finished = threading.Event()
+        self._session = self._create_session()
 
         if excluded_urls is None:
             excluded_urls = set([])
         self._excluded_urls = excluded_urls
 
-        self._crawling_queue.put(self._base_url)
+        self._crawling_queue.put(UrlJob(self._base_url, _cached_urlsplit(self._base_url)))
+
+    def _create_session(self) -> requests.Session:
+        """
+        Session shared by all workers, pool is sized
+        to keep a warm connection for each of them
+        """
+        session = requests.Session()
+        session.headers["User-Agent"] = Crawler.User_Agent
+
+        # default pool_connections keeps pools of redirect targets
+        # from evicting the crawled host's warm connections
+        adapter = HTTPAdapter(pool_maxsize=self._num_workers * 2,
+                              max_retries=Retry(total=1))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _check_robots(self):
+        robots_url = urljoin(self._base_url, 'robots.txt')
+        self._robots_parser = robots.RobotsParser.from_uri(robots_url)
+
+    def _wait_crawling(self):
+        # every url put to queue is marked done by workers, so join returns
+        # only when no url is being crawled and nothing is left in queue
+        self._crawling_queue.join()
+        self._crawling_finished.set()
 
     def run(self):
         start_time = datetime.now()
 
+        # load and parse robots once, workers share the parser
+        self._check_robots()
+
         for i in range(self._num_workers):
             crawler = Crawler(self._base_url, self._crawling_queue,
-                              self._crawled_urls, self._excluded_urls,
-                              self._sitemap)
+                              self._crawled_urls, self._enqueued_urls,
+                              self._enqueued_lock, self._excluded_urls,
+                              self._sitemap, self._robots_parser,
+                              self._session)
             crawler.setName(f"Crawler-{i}")
             crawler.start()
             self._crawler_workers.append(crawler)
 
-        while threading.active_count() != 1:
-            logging.info(f"Current urls count: {len(self._sitemap.url)}")
-            time.sleep(2)
+        threading.Thread(target=self._wait_crawling, name="Waiter", daemon=True).start()
+        while not self._crawling_finished.wait(2):
+            logging.info(f"Current urls count: {len(self._sitemap)}")
+
+        # stop signal, each worker passes it on before exiting
+        self._crawling_queue.put(None)
+        for crawler in self._crawler_workers:
+            crawler.join()
+        self._session.close()
 
         stop_time = datetime.now()
 
         logging.info(f"Crawling time: {stop_time - start_time}")
-        logging.info(f"Total crawled urls: {len(self._sitemap.url)}")
+        logging.info(f"Total crawled urls: {len(self._sitemap)}")
         self._sitemap.create_sitemap()
         logging.info("Sitemap files successful created in same directory")
 